@@ -58,13 +58,19 @@ Additional functionality:
      - basic block boundaries generation (function)
 """
 
+import csv
+import hashlib
+import os
+import pickle
 import sys
 import idc
 import idaapi
 import idautils
 import ida_idp
+import ida_lines
 import math
 import gc
+from bisect import bisect_right
 from time import strftime
 from collections import defaultdict
 from idaapi import *
@@ -107,6 +113,83 @@ metrics_names = ["Lines of code", "Basic blocks count", "Routines calls count",
                  "Cocol"]
 
 
+# Precomputed log2 values: the per-function operator/operand
+# vocabularies are small integers, so table lookups replace the
+# transcendental call on the per-function path.
+_LOG2_TABLE_SIZE = 8192
+_LOG2_TABLE = [0.0] + [math.log2(i) for i in range(1, _LOG2_TABLE_SIZE)]
+
+
+def _log2(value):
+    if 0 < value < _LOG2_TABLE_SIZE:
+        return _LOG2_TABLE[value]
+    return math.log2(value)
+
+
+# Translation table used to strip spaces from operand strings in one
+# pass instead of str.replace.
+_no_space = str.maketrans("", "", " ")
+
+# Pre-bound IDA callables for the per-instruction paths; a module
+# global costs one dict lookup instead of the module-attribute chain on
+# every call.
+_print_operand = idc.print_operand
+_print_insn_mnem = idc.print_insn_mnem
+_next_head = idc.next_head
+_decode_insn = ida_ua.decode_insn
+_insn_t = ida_ua.insn_t
+_is_call_insn = ida_idp.is_call_insn
+_get_full_flags = ida_bytes.get_full_flags
+_BADADDR = idaapi.BADADDR
+
+# ida_idp.has_insn_feature answers per itype, and itype values repeat
+# heavily across a binary, so the verdicts are memoized module-wide.
+_insn_feature_cache = dict()
+
+
+def _has_insn_feature(itype, feature):
+    key = (itype, feature)
+    cached = _insn_feature_cache.get(key, None)
+    if cached == None:
+        cached = ida_idp.has_insn_feature(itype, feature)
+        _insn_feature_cache[key] = cached
+    return cached
+
+
+# Per-function section of the text report; one format call per function
+# replaces the former line-by-line concatenation and write calls.
+_FUNC_TMPL = """{name}
+  Lines of code in the function: {loc_count}
+  Bbls count: {bbl_count}
+  Condition count: {condition_count}
+  Calls count: {calls_count}
+  Assignments count: {assign_count}
+  Cyclomatic complexity: {CC}
+  Cyclomatic complexity modified: {CC_modified}
+  Jilb's metric: {CL}
+  ABC: {ABC}
+  R count: {R}
+    Halstead.B: {halstead_B}
+    Halstead.E: {halstead_E}
+    Halstead.D: {halstead_D}
+    Halstead.N*: {halstead_Ni}
+    Halstead.V: {halstead_V}
+    Halstead.N1: {halstead_N1}
+    Halstead.N2: {halstead_N2}
+    Halstead.n1: {halstead_n1}
+    Halstead.n2: {halstead_n2}
+  Pivovarsky: {Pivovarsky}
+  Harrison: {Harrison}
+  Cocol metric{Cocol}
+  Boundary value: {boundary_values}
+  Span metric: {span_metric}
+  Global vars metric:{global_vars_metric}
+  Oviedo metric: {Oviedo}
+  Chepin metric: {Chepin}
+  CardnGlass metric: {CardnGlass}
+  Henry&Cafura metric: {HenrynCafura}
+"""
+
 class Halstead_metric:
     def __init__(self):
         self.n1 = 0
@@ -123,13 +206,12 @@ class Halstead_metric:
         n = self.n1 + self.n2
         N = self.N1 + self.N2
         try:
-            self.Ni = self.n1 * math.log(self.n1, 2) + self.n2 * math.log(
-                self.n2, 2)
+            self.Ni = self.n1 * _log2(self.n1) + self.n2 * _log2(self.n2)
         except:
             print(
                 "WARNING: Ni value for Halstead metric is too large to calculate"
             )
-        self.V = N * math.log(n, 2)
+        self.V = N * _log2(n)
         if self.n2 != 0:
             self.D = (self.n1 / 2) * (self.N2 / self.n2)
         else:
@@ -141,12 +223,24 @@ class Halstead_metric:
 
 
 global_vars_dict = {}
+# Incoming code-reference counts per function, shared across metric
+# evaluations within a run.
+_fan_in_cache = {}
 
 
 class Metrics_function:
-    def __init__(self, function_ea, metrics_mask):
-        self.function_name = idc.get_func_name(function_ea)
+    def __init__(self,
+                 function_ea,
+                 metrics_mask,
+                 function_name=None,
+                 callers_of=None):
+        if function_name == None:
+            function_name = idc.get_func_name(function_ea)
+        self.function_name = function_name
         self.function_ea = function_ea
+        # {callee ea: [call site, ...]} built once by the driver; None
+        # means fall back to per-function xref queries
+        self.callers_of = callers_of
         self.function_start = function_ea
         self.function_end = idc.find_func_end(self.function_ea)
         self.metrics_mask = metrics_mask
@@ -165,22 +259,28 @@ class Metrics_function:
         self.Harrison = 0
         self.boundary_values = 0.0
         self.span_metric = 0
-        self.vars_local = dict()
         self.vars_args = dict()
         self.Oviedo = 0
         self.Chepin = 0
         self.global_vars_access = 0
-        self.global_vars_used = dict()
         self.global_vars_metric = 0.0
         self.bbls_boundaries = dict()
+        self.head_to_bbl_head = dict()
         self.CardnGlass = 0
         self.fan_in_i = 0
         self.fan_in_s = 0
         self.fan_out_i = 0
-        self.calls_dict = dict()
         self.fan_out_s = 0
         self.HenrynCafura = 0
         self.Cocol = 0
+        # Per-instruction caches filled on first access; the metric
+        # helpers hit the same addresses over and over, and every miss
+        # is an IDA decode round-trip.
+        self._ops_cache = dict()
+        self._itype_cache = dict()
+        self._mnem_cache = dict()
+        self._disasm_cache = dict()
+        self._global_cache = dict()
 
     def start_analysis(self):
         """
@@ -190,135 +290,193 @@ class Metrics_function:
         """
         function_ea = self.function_ea
         f_start = function_ea
-        f_end = idc.find_func_end(function_ea)
+
+        # Local bindings for the hottest SDK entry points: LOAD_FAST
+        # beats LOAD_GLOBAL + LOAD_ATTR in the per-instruction loop.
+        _get_full_flags = ida_bytes.get_full_flags
+        _is_code = is_code
+        _is_flow = is_flow
+        _next_head = idc.next_head
+        _prev_head = idc.prev_head
+        _print_insn_mnem = idc.print_insn_mnem
+        _code_refs_from = idautils.CodeRefsFrom
+        _get_switch_info = ida_nalt.get_switch_info
+        _BADADDR = idaapi.BADADDR
 
         edges = set()
         boundaries = set((f_start, ))
-        mnemonics = dict()
-        operands = dict()
+        mnemonics = defaultdict(int)
+        operands = defaultdict(int)
+        # Per-function scratch; locals so everything is released as soon
+        # as the analysis returns instead of living on the instance.
+        vars_local = dict()
+        global_vars_used = dict()
+        calls_dict = defaultdict(int)
         switchea = set()
         node_graph = None
         cases_in_switches = 0
+        # Instruction type counters indexed by inType value; unpacked
+        # into the named metrics after the scan.
+        type_counters = [0] * len(inType)
+        # All heads in chunk order, reused by get_bbls so the module is
+        # not re-walked through the SDK a second time.
+        all_heads = []
+        # Per-head flags cache to avoid repeated IDA SDK round-trips:
+        # flags are queried again for the flow checks below. Instruction
+        # types and mnemonics go into the instance-level caches shared
+        # with the metric helpers.
+        flags_by_head = dict()
+        mnem_cache = self._mnem_cache
+
+        def get_flags(ea):
+            flags = flags_by_head.get(ea, None)
+            if flags == None:
+                flags = _get_full_flags(ea)
+                flags_by_head[ea] = flags
+            return flags
 
         chunks = self.enumerate_function_chunks()
+        # Sorted chunk bounds for O(log n) reference filtering below.
+        chunks_sorted = sorted(chunks)
+        chunk_starts = [c[0] for c in chunks_sorted]
+        chunk_ends = [c[1] for c in chunks_sorted]
+        single_chunk = chunks_sorted[0] if len(chunks_sorted) == 1 else None
         # For each defined chunk in the function.
         for chunk in chunks:
+            # Materialize the heads once and pre-filter code heads in a
+            # tight pass, so the expensive per-instruction analysis below
+            # only ever runs on instructions.
+            code_heads = []
             for head in idautils.Heads(*chunk):
                 # If the element is an instruction
-                if head == idaapi.BADADDR:
+                if head == _BADADDR:
                     # the idautils.Heads is a generator, have to check during iterating
                     raise Exception("Invalid head for parsing")
-                if is_code(ida_bytes.get_full_flags(head)):
-                    self.loc_count += 1
-                    # Get the references made from the current instruction
-                    # and keep only the ones local to the function.
-                    refs = idautils.CodeRefsFrom(head, 0)
-                    refs_filtered = set()
-                    for ref in refs:
-                        if ref == idaapi.BADADDR:
-                            print("Invalid reference for head", head)
-                            raise Exception("Invalid reference for head")
-                        for chunk_filter in chunks:
-                            if ref >= chunk_filter[0] and ref < chunk_filter[1]:
-                                refs_filtered.add(ref)
-                                break
-                    refs = refs_filtered
-                    # Get instruction type and increase metrics
-                    instruction_type = self.GetInstructionType(head)
-                    if instruction_type == inType.CONDITIONAL_BRANCH:
-                        self.condition_count += 1
-                    elif instruction_type == inType.CALL:
-                        self.calls_count += 1
-                        # set dict of function calls
-                        opnd_type = idc.get_operand_type(head, 0)
-                        opnd = get_operand_value(head, 0)
-                        if opnd_type == idc.o_reg:
-                            key = f"reg_{opnd}"
-                        elif opnd_type == idc.o_phrase:
-                            key = f"phrase_{opnd}"
-                        elif opnd_type == idc.o_displ:
-                            key = f"displ_{opnd}"
-                        elif opnd_type in [idc.o_mem, idc.o_imm, idc.o_far, idc.o_near]:
-                            key = f"mem_{opnd}"
-                        else:
-                            print("Impossible@", head)
-                            raise Exception("Cthulhu has awakened")
-                        self.calls_dict[key] = self.calls_dict.get(key, 0) + 1
-                    elif instruction_type == inType.ASSIGNMENT:
-                        self.assign_count += 1
-                    # Get the mnemonic and increment the mnemonic count
-                    mnem = idc.print_insn_mnem(head)
-                    mnemonics[mnem] = mnemonics.get(mnem, 0) + 1
-                    # switch case count
-                    switch_info = ida_nalt.get_switch_info(head)
+                all_heads.append(head)
+                if _is_code(get_flags(head)):
+                    code_heads.append(head)
+            self.loc_count += len(code_heads)
+            for head in code_heads:
+                # Get the references made from the current instruction
+                # and keep only the ones local to the function.
+                refs = _code_refs_from(head, 0)
+                refs_filtered = set()
+                for ref in refs:
+                    if ref == _BADADDR:
+                        print("Invalid reference for head", head)
+                        raise Exception("Invalid reference for head")
+                    if single_chunk != None:
+                        if ref >= single_chunk[0] and ref < single_chunk[1]:
+                            refs_filtered.add(ref)
+                    else:
+                        i = bisect_right(chunk_starts, ref) - 1
+                        if i >= 0 and ref < chunk_ends[i]:
+                            refs_filtered.add(ref)
+                refs = refs_filtered
+                # Get instruction type and increase metrics
+                instruction_type = self.GetInstructionType(head)
+                type_counters[instruction_type.value] += 1
+                if instruction_type == inType.CALL:
+                    # set dict of function calls. Tuple keys are cheaper
+                    # to build and hash than formatted strings; the
+                    # mem/imm/far/near group is collapsed to o_mem as the
+                    # string keys used to do.
+                    ops = self.get_instr_operands(head)
+                    if not ops:
+                        print("Impossible@", head)
+                        raise Exception("Cthulhu has awakened")
+                    _, opnd_type, opnd = ops[0]
+                    if opnd_type in (idc.o_reg, idc.o_phrase, idc.o_displ):
+                        key = (opnd_type, opnd)
+                    elif opnd_type in (idc.o_mem, idc.o_imm, idc.o_far,
+                                       idc.o_near):
+                        key = (idc.o_mem, opnd)
+                    else:
+                        print("Impossible@", head)
+                        raise Exception("Cthulhu has awakened")
+                    calls_dict[key] += 1
+                # Get the mnemonic and increment the mnemonic count
+                mnem = _print_insn_mnem(head)
+                mnem_cache[head] = mnem
+                mnemonics[mnem] += 1
+                # switch case count. Switch info is only ever attached to
+                # the jump through the case table, so plain instructions
+                # can skip the SDK query entirely.
+                if instruction_type in (inType.CONDITIONAL_BRANCH,
+                                        inType.UNCONDITIONAL_BRACH,
+                                        inType.CALL):
+                    switch_info = _get_switch_info(head)
                     if switch_info is not None and switch_info.startea not in switchea:
                         switchea.add(switch_info.startea)
                         cases_in_switches += switch_info.ncases
-                    if instruction_type != inType.CONDITIONAL_BRANCH and instruction_type != inType.CALL:
-                        ops = self.get_instr_operands(head)
-                        for idx, (op, op_type) in enumerate(ops):
-                            operands[op] = operands.get(op, 0) + 1
-                            if op_type == idc.o_mem:
-                                # TODO: refactor this
-                                if self.is_var_global(
-                                        idc.get_operand_value(head, idx),
-                                        head) and "__" not in op:
-                                    global_vars_dict[op] = operands.get(op,
-                                                                        0) + 1
-                                    self.global_vars_used.setdefault(
-                                        op, []).append(hex(head))
-                                    self.global_vars_access += 1
-                                elif "__" not in op:
-                                    # static variable
-                                    name = op
-                                    self.vars_local.setdefault(name,
-                                                               []).append(
-                                                                   hex(head))
-                            elif op_type == idc.o_phrase or op_type == idc.o_displ:
-                                name = self.get_local_var_name(op, head)
-                                if name:
-                                    self.vars_local.setdefault(name,
-                                                               []).append(
-                                                                   hex(head))
-
-                    if refs:
-                        # If the flow continues also to the next (address-wise)
-                        # instruction, we add a reference to it.
-                        # For instance, a conditional jump will not branch
-                        # if the condition is not met, so we save that
-                        # reference as well.
-                        next_head = idc.next_head(head, chunk[1])
-                        # if next_head == idaapi.BADADDR:
-                            # print("Invalid next head after ", head)
-                            # raise Exception("Invalid next head")
-                        if is_flow(ida_bytes.get_full_flags(next_head)):
-                            refs.add(next_head)
-
-                        # Update the boundaries found so far.
-                        boundaries.update(refs)
-                        # For each of the references found, and edge is
-                        # created.
-                        for r in refs:
-                            # If the flow could also come from the address
-                            # previous to the destination of the branching
-                            # an edge is created.
-                            if is_flow(ida_bytes.get_full_flags(r)):
-                                prev_head = idc.prev_head(r, chunk[0])
-                                if prev_head == idaapi.BADADDR:
-                                    edges.add((hex(head), hex(r)))
-                                    #raise Exception("invalid reference to previous instruction for", hex(r))
-                                else:
-                                    edges.add((hex(prev_head), hex(r)))
-                            edges.add((hex(head), hex(r)))
+                if instruction_type != inType.CONDITIONAL_BRANCH and instruction_type != inType.CALL:
+                    ops = self.get_instr_operands(head)
+                    for op, op_type, op_value in ops:
+                        operands[op] += 1
+                        if op_type == idc.o_mem:
+                            # TODO: refactor this
+                            if self.is_var_global(op_value,
+                                                  head) and "__" not in op:
+                                global_vars_dict[op] = operands.get(op,
+                                                                    0) + 1
+                                global_vars_used.setdefault(
+                                    op, []).append(head)
+                                self.global_vars_access += 1
+                            elif "__" not in op:
+                                # static variable
+                                name = op
+                                vars_local.setdefault(name,
+                                                      []).append(head)
+                        elif op_type == idc.o_phrase or op_type == idc.o_displ:
+                            name = self.get_local_var_name(op, head)
+                            if name:
+                                vars_local.setdefault(name,
+                                                      []).append(head)
+
+                if refs:
+                    # If the flow continues also to the next (address-wise)
+                    # instruction, we add a reference to it.
+                    # For instance, a conditional jump will not branch
+                    # if the condition is not met, so we save that
+                    # reference as well.
+                    next_head = _next_head(head, chunk[1])
+                    # if next_head == _BADADDR:
+                        # print("Invalid next head after ", head)
+                        # raise Exception("Invalid next head")
+                    if _is_flow(get_flags(next_head)):
+                        refs.add(next_head)
+
+                    # Update the boundaries found so far.
+                    boundaries.update(refs)
+                    # For each of the references found, and edge is
+                    # created.
+                    for r in refs:
+                        # If the flow could also come from the address
+                        # previous to the destination of the branching
+                        # an edge is created.
+                        if _is_flow(get_flags(r)):
+                            prev_head = _prev_head(r, chunk[0])
+                            if prev_head == _BADADDR:
+                                edges.add((head, r))
+                                #raise Exception("invalid reference to previous instruction for", hex(r))
+                            else:
+                                edges.add((prev_head, r))
+                        edges.add((head, r))
         # i#7: New algorithm of edges and boundaries constructing is required..
         # Now boundaries and edges are making by using internal IDA functionality
         # but it doesn't work for functions which have jumps beyond function boundaries
         # (or jumps to "red" areas of code). Now we're generating warning in such
         # situations but we need to manually parse all instructions.
-        bbls = self.get_bbls(chunks, boundaries, edges)
-        # save bbls boundaries in dict
-        for bbl in bbls:
-            self.bbls_boundaries[bbl[0]] = [x for x in bbl]
+        self.condition_count = type_counters[inType.CONDITIONAL_BRANCH.value]
+        self.calls_count = type_counters[inType.CALL.value]
+        self.assign_count = type_counters[inType.ASSIGNMENT.value]
+        bbls = self.get_bbls(all_heads, boundaries, edges, self._itype_cache)
+        # Index the bbls once by first and last instruction; the graph
+        # and metric consumers below share these instead of re-building
+        # their own copies of the same mapping.
+        bbls_by_first = {bbl[0]: bbl for bbl in bbls}
+        bbls_by_last = {bbl[-1]: bbl for bbl in bbls}
+        self.bbls_boundaries = bbls_by_first
         #Cyclomatic complexity CC = E - V + 2
         if self.metrics_mask["cc"] == 1 or self.metrics_mask["cocol"] == 1:
             self.CC = len(edges) - len(boundaries) + 2
@@ -336,18 +494,19 @@ class Metrics_function:
                                    self.calls_count)/self.loc_count
         # ABC metric: ABC = sqrt(A*A + B*B + C*C)
         if self.metrics_mask["abc"] == 1:
-            self.ABC = pow(self.assign_count, 2) +\
-                                   pow(self.condition_count, 2) +\
-                                   pow(self.calls_count, 2)
+            self.ABC = self.assign_count * self.assign_count +\
+                                   self.condition_count * self.condition_count +\
+                                   self.calls_count * self.calls_count
             self.ABC = math.sqrt(self.ABC)
         # Create node graph
         if self.metrics_mask["harr"] == 1 or self.metrics_mask[
                 "bound"] == 1 or self.metrics_mask["pi"] == 1:
-            node_graph = self.make_graph(edges, bbls, boundaries)
+            node_graph = self.make_graph(edges, bbls_by_first, bbls_by_last,
+                                         boundaries)
 
         #Harrison metric: f = sum(ci) i: 0...n
         if self.metrics_mask["harr"] == 1:
-            self.Harrison = self.get_harrison_metric(node_graph, bbls)
+            self.Harrison = self.get_harrison_metric(node_graph, bbls_by_first)
 
         #boundary values metric: Sa = sum(nodes_complexity)
         if self.metrics_mask["bound"] == 1:
@@ -382,32 +541,22 @@ class Metrics_function:
 
         # Oviedo metric C = aCF + bsum(DFi)
         if self.metrics_mask["oviedo"] == 1:
-            self.Oviedo = len(edges) + self.get_oviedo_df(self.vars_local)
+            self.Oviedo = len(edges) + self.get_oviedo_df(vars_local)
 
         # Chepin metric Q= P+2M+3C
         if self.metrics_mask["chepin"] == 1:
-            self.Chepin = self.get_chepin(self.vars_local, function_ea)
+            self.Chepin = self.get_chepin(vars_local, function_ea)
 
         # Henry and Cafura metric
         if self.metrics_mask["h&c"] == 1 or self.metrics_mask["c&s"] == 1:
-            self.HenrynCafura = self.get_henryncafura_metric(function_ea)
+            self.HenrynCafura = self.get_henryncafura_metric(
+                function_ea, vars_local, global_vars_used, calls_dict)
 
         # Card and Glass metric C = S + D
         if self.metrics_mask["c&s"] == 1:
-            self.CardnGlass = pow((self.fan_out_i + self.fan_out_s), 2) +\
-                                  (len(self.vars_args))/(self.fan_out_i + self.fan_out_s + 1)
-        #free memory
-        if node_graph:
-            node_graph.clear()
-        self.vars_local.clear()
-        self.vars_args.clear()
-        self.global_vars_used.clear()
-        self.calls_dict.clear()
-        mnemonics.clear()
-        operands.clear()
-        edges.clear()
-        boundaries.clear()
-        gc.collect()
+            fan_out = self.fan_out_i + self.fan_out_s
+            self.CardnGlass = fan_out * fan_out +\
+                                  (len(self.vars_args))/(fan_out + 1)
 
     def enumerate_function_chunks(self):
         """
@@ -415,6 +564,12 @@ class Metrics_function:
         @f_start - first address of the function
         @return - list of chunks
         """
+        # Fast path: most functions have no tail chunks, so their bounds
+        # come from a single get_func call instead of walking the chunk
+        # iterator.
+        func = ida_funcs.get_func(self.function_ea)
+        if func != None and func.tailqty == 0:
+            return [(func.start_ea, func.end_ea)]
         # Enumerate all chunks in the function
         chunks = list()
         next_chunk = idc.first_func_chunk(self.function_ea)
@@ -447,7 +602,7 @@ class Metrics_function:
                 print("WARNING: empty usage list for ", local_var)
                 continue
             for instr_addr in usage_list:
-                instr_mnem = idc.print_insn_mnem(int(instr_addr, 16))
+                instr_mnem = self.get_instr_mnem(instr_addr)
                 if instr_mnem.startswith('cmp') or instr_mnem.startswith(
                         'test'):
                     tmp_dict.setdefault(local_var, []).append(instr_addr)
@@ -464,19 +619,30 @@ class Metrics_function:
         chepin = p + 2 * m + 3 * c
         return chepin
 
-    def get_henryncafura_metric(self, function_ea):
+    def get_henryncafura_metric(self, function_ea, vars_local,
+                                global_vars_used, calls_dict):
         '''
         The function performs evaluation of Henry&Cafura metric
         @function_ea - function entry address
-        @function_metrics - function_metrics structure
+        @vars_local - local variables usage dictionary
+        @global_vars_used - global variables usage dictionary
+        @calls_dict - distinct call targets dictionary
         @return - Henry&Cafura metric
         '''
-        self.fan_out_s = len(self.calls_dict)
-        refs_to = idautils.CodeRefsTo(function_ea, 0)
-        self.fan_in_s = sum(1 for y in refs_to)
+        self.fan_out_s = len(calls_dict)
+        if self.callers_of != None:
+            fan_in_s = len(self.callers_of.get(function_ea, ()))
+        else:
+            fan_in_s = _fan_in_cache.get(function_ea, None)
+            if fan_in_s == None:
+                # len(list(...)) materializes the ref generator in C
+                # instead of ticking a Python generator per reference.
+                fan_in_s = len(list(idautils.CodeRefsTo(function_ea, 0)))
+                _fan_in_cache[function_ea] = fan_in_s
+        self.fan_in_s = fan_in_s
 
         (count, self.vars_args) = self.get_function_args_count(
-            function_ea, self.vars_local)
+            function_ea, vars_local)
 
         # check input args
         (read, write) = self.get_unique_vars_read_write_count(self.vars_args)
@@ -484,13 +650,14 @@ class Metrics_function:
         self.fan_out_i += write
         # check global variables list
         (read,
-         write) = self.get_unique_vars_read_write_count(self.global_vars_used)
+         write) = self.get_unique_vars_read_write_count(global_vars_used)
         self.fan_in_i += read
         self.fan_out_i += write
 
         fan_in = self.fan_in_s + self.fan_in_i
         fan_out = self.fan_out_s + self.fan_out_i
-        return self.CC + pow((fan_in + fan_out), 2)
+        fan_total = fan_in + fan_out
+        return self.CC + fan_total * fan_total
 
     def get_bbl_head(self, head):
         """
@@ -499,44 +666,90 @@ class Metrics_function:
         @head - address of arbitrary instruction in the basic block.
         @return - head address of the basic block.
         """
+        return self.head_to_bbl_head.get(head, head)
 
-        while True:
-            prev_head = idc.prev_head(head, 0)
-            if not is_flow(ida_bytes.get_full_flags(prev_head)):
-                break
-            head = prev_head
-            if prev_head >= SegEnd(head):
-                raise Exception("Can't identify bbl head")
-
-        if prev_head == idaapi.BADADDR:
-            return head
-        else:
-            return prev_head
-
-    def get_subgraph_nodes_count(self, node, node_graph, nodes_passed):
+    def compute_reachable_counts(self, node_graph):
         """
-        The function calculates total count of nodes in the subgraph for
-        selected node.
-        @node - first node to get subgraph
+        The function computes, for every node, the count of nodes
+        reachable from it (the node itself excluded) in a single pass
+        over the graph. Strongly connected components are condensed
+        first with an iterative Tarjan walk, then reachable sets are
+        propagated over the condensation in reverse topological order
+        as integer bitsets, so shared subgraphs are merged instead of
+        being re-walked once per starting node.
         @node_graph - node graph dictionary (result of make_graph function)
-        @nodes_passed - list of passed nodes
-        @return - total count of nodes in the subgraph
+        @return - dictionary of reachable nodes count for each node
         """
-        nodes_count = 0
-        if node in nodes_passed:
-            #already passed
-            return 1
-        else:
-            nodes_passed.append(node)
-        child_nodes = node_graph.get(node, None)
-        if child_nodes != None:
-            for child_node in child_nodes:
-                if child_node in nodes_passed:
+        index_of = dict()
+        lowlink = dict()
+        on_stack = set()
+        scc_stack = []
+        scc_of = dict()
+        sccs = []
+        counter = 0
+
+        def children(node):
+            child_nodes = node_graph.get(node, None)
+            return child_nodes if child_nodes != None else ()
+
+        for root in node_graph:
+            if root in index_of:
+                continue
+            index_of[root] = lowlink[root] = counter
+            counter += 1
+            scc_stack.append(root)
+            on_stack.add(root)
+            work = [(root, iter(children(root)))]
+            while work:
+                node, child_iter = work[-1]
+                descended = False
+                for child in child_iter:
+                    if child not in index_of:
+                        index_of[child] = lowlink[child] = counter
+                        counter += 1
+                        scc_stack.append(child)
+                        on_stack.add(child)
+                        work.append((child, iter(children(child))))
+                        descended = True
+                        break
+                    elif child in on_stack:
+                        if index_of[child] < lowlink[node]:
+                            lowlink[node] = index_of[child]
+                if descended:
                     continue
-                nodes_count += self.get_subgraph_nodes_count(
-                    child_node, node_graph, nodes_passed)
-                nodes_count += 1
-        return nodes_count
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    if lowlink[node] < lowlink[parent]:
+                        lowlink[parent] = lowlink[node]
+                if lowlink[node] == index_of[node]:
+                    component = []
+                    while True:
+                        member = scc_stack.pop()
+                        on_stack.discard(member)
+                        scc_of[member] = len(sccs)
+                        component.append(member)
+                        if member == node:
+                            break
+                    sccs.append(component)
+
+        # Tarjan emits components callees-first, so every child component
+        # mask is already final when its parents are folded in.
+        bit_of = {node: 1 << i for i, node in enumerate(index_of)}
+        scc_masks = []
+        for scc_index, component in enumerate(sccs):
+            mask = 0
+            for member in component:
+                mask |= bit_of[member]
+                for child in children(member):
+                    if scc_of[child] != scc_index:
+                        mask |= scc_masks[scc_of[child]]
+            scc_masks.append(mask)
+
+        return {
+            node: bin(scc_masks[scc_of[node]]).count("1") - 1
+            for node in index_of
+        }
 
     def get_boundary_value_metric(self, node_graph, pivovarsky=False):
         """
@@ -547,6 +760,7 @@ class Metrics_function:
         @return - boundary value or Pi value
         """
         boundary_value = 0
+        reachable_counts = self.compute_reachable_counts(node_graph)
         for node in node_graph:
             childs = node_graph.get(node, None)
             if childs == None:
@@ -554,12 +768,10 @@ class Metrics_function:
             out_edges_count = len(childs)
             if pivovarsky:
                 if out_edges_count == 2:
-                    boundary_value += self.get_subgraph_nodes_count(
-                        node, node_graph, list())
+                    boundary_value += reachable_counts[node]
             else:
                 if out_edges_count >= 2:
-                    boundary_value += self.get_subgraph_nodes_count(
-                        node, node_graph, list())
+                    boundary_value += reachable_counts[node]
                 else:
                     boundary_value += 1
         if not pivovarsky:
@@ -573,43 +785,42 @@ class Metrics_function:
         @node - node address to get node complexity
         @node_graph - node graph dictionary (result of make_graph function)
         @bbls_dict - basic block boundaries dictionary
-        @nodes_passed - list of passed nodes_count
-        @return - node complexity by using loc measure and list of passed nodes
+        @nodes_passed - set of passed nodes
+        @return - node complexity by using loc measure
         """
         loc_measure = 0
         # i#3: add more initial complexity metrics e.g. Halstead
         if node in nodes_passed:
             #already passed
-            return 0, nodes_passed
-        else:
-            nodes_passed.append(node)
-        child_nodes = node_graph.get(node, None)
-        if child_nodes != None:
+            return 0
+        nodes_passed.add(node)
+        stack = [node]
+        while stack:
+            current = stack.pop()
+            child_nodes = node_graph.get(current, None)
+            if child_nodes == None:
+                continue
             for child_node in child_nodes:
                 if child_node in nodes_passed:
                     continue
                 bbls_node = bbls_dict.get(child_node, None)
                 if bbls_node == None:
                     print("WARNING: couldn't find bbl for child node: ",
-                          child_node)
-                    loc_measure += 0
+                          hex(child_node))
                 else:
+                    nodes_passed.add(child_node)
                     loc_measure += len(bbls_node)
-                    loc_measure += self.get_node_complexity(
-                        child_node, node_graph, bbls_dict, nodes_passed)
+                    stack.append(child_node)
         return loc_measure
 
-    def get_harrison_metric(self, node_graph, bbls):
+    def get_harrison_metric(self, node_graph, bbls_dict):
         """
         The function calculates Harrison metric.
         @node_graph - node graph dictionary (result of make_graph function)
-        @bbls - bbls set
+        @bbls_dict - bbls keyed by their first instruction
         @return - Harrison metric
         """
-        bbls_dict = dict()
         loc_measure = 0
-        for bbl in bbls:
-            bbls_dict[bbl[0]] = [x for x in bbl]
         for node in node_graph:
             childs = node_graph.get(node, None)
             if childs == None or len(childs) != 2:
@@ -617,136 +828,146 @@ class Metrics_function:
                 if loc_measure_node != None:
                     loc_measure += len(loc_measure_node)
                 else:
-                    print("WARNING: couldn't find bbl for node: ", node)
+                    print("WARNING: couldn't find bbl for node: ", hex(node))
             else:
                 loc_measure += self.get_node_complexity(
-                    node, node_graph, bbls_dict, list())
+                    node, node_graph, bbls_dict, set())
                 bbls_predicate_node = bbls_dict.get(node, None)
                 if bbls_predicate_node == None:
                     print("WARNING: couldn't find bbl for predicate node: ",
-                          node)
+                          hex(node))
                 else:
                     loc_measure += len(bbls_predicate_node)
         return loc_measure
 
     # i#4 Support graphs with several terminal nodes
     # i#5 Ignore nodes without incoming edges
-    def make_graph(self, edges, bbls, boundaries):
+    def make_graph(self, edges, bbls_by_first, bbls_by_last, boundaries):
         """
         The function makes nodes graph by using edges,
         bbls and boundaries sets.
         @edges - set of edges
-        @bbls - set of bbls
+        @bbls_by_first - bbls keyed by their first instruction
+        @bbls_by_last - bbls keyed by their last instruction
         @boundaries - set of boundaries
         @return node graph
         """
         node_graph = dict()
         edges_dict = dict()
-        bbls_dict = dict()
 
         # i#6 This function needs re-factoring. Now it has ugly
         # additional functionality to make the graph correct for
         # functions with chunks and to add terminal nodes. (xref i#7)
 
         for edge_from, edge_to in edges:
-            if edge_from == hex(idaapi.BADADDR):
-                raise Exception("Invalid edge reference", edge_from)
+            if edge_from == idaapi.BADADDR:
+                raise Exception("Invalid edge reference", hex(edge_from))
             edges_dict.setdefault(edge_from, []).append(edge_to)
-        for bbl in bbls:
-            bbls_dict[bbl[len(bbl) - 1]] = [x for x in bbl]
-        boundaries_list = [hex(x) for x in boundaries]
 
         for edge_from in edges_dict:
             node_edges_to = edges_dict[edge_from]
             if node_edges_to == None:
                 raise Exception("Error when creating node graph")
             # check for additional chunks (xref i#6)
-            if edge_from not in boundaries_list:
-                bbl_edge_from = bbls_dict.get(edge_from, None)
+            if edge_from not in boundaries:
+                bbl_edge_from = bbls_by_last.get(edge_from, None)
                 if bbl_edge_from == None:
-                    print("WARNING: Can't find bbl for ", edge_from)
+                    print("WARNING: Can't find bbl for ", hex(edge_from))
                 else:
                     node_graph[bbl_edge_from[0]] = node_edges_to
             else:
                 node_graph[edge_from] = node_edges_to
 
         if len(node_graph) == 0 and len(edges_dict) == 0 and len(
-                boundaries_list) == 1:
-            node_graph[boundaries_list[
-                0]] = None  #it means that graph has only single root node
+                boundaries) == 1:
+            node_graph[next(
+                iter(boundaries)
+            )] = None  #it means that graph has only single root node
         elif len(node_graph) == 0 and len(edges_dict) != 0:
             raise Exception("Error when creating node graph")
         #add terminal nodes (xref i#6)
-        for bbl in bbls:
-            check_bbl = node_graph.get(bbl[0], None)
+        for bbl_head in bbls_by_first:
+            check_bbl = node_graph.get(bbl_head, None)
             if check_bbl == None:
-                node_graph[bbl[0]] = None
+                node_graph[bbl_head] = None
         return node_graph
 
-    def get_bbls(self, chunks, boundaries, edges):
+    def get_bbls(self, heads, boundaries, edges, itype_by_head):
         """
         Set bbls using edges and boundaries
-        @chunks - a list of function chunks
+        @heads - all function heads in chunk order, collected during
+        start_analysis
         @boundaries - a list of function boundaries (see get_static_metrics)
         @edges - a list of function edges (see get_static_metrics)
+        @itype_by_head - instruction types cached during start_analysis
         @return - a set of bbls boundaries
         """
         bbls = []
         bbl = []
         # NOTE: We can handle if jump xrefs to chunk address space.
-        for chunk in chunks:
-            for head in idautils.Heads(*chunk):
-                if head in boundaries or head in edges:
-                    if len(bbl) > 0:
-                        bbls.append(bbl)
-                        bbl = []
-                    bbl.append(hex(head))
-                elif self.GetInstructionType(
-                        head) == inType.CONDITIONAL_BRANCH:
-                    bbl.append(hex(head))
+        for head in heads:
+            if head in boundaries or head in edges:
+                if len(bbl) > 0:
                     bbls.append(bbl)
                     bbl = []
-                else:
-                    bbl.append(hex(head))
+                bbl.append(head)
+            elif itype_by_head.get(head, None) == inType.CONDITIONAL_BRANCH:
+                bbl.append(head)
+                bbls.append(bbl)
+                bbl = []
+            else:
+                bbl.append(head)
         # add last basic block
         if len(bbl) > 0:
             bbls.append(bbl)
+        # reverse head -> bbl head mapping for get_bbl_head
+        for bbl in bbls:
+            bbl_head = bbl[0]
+            for head in bbl:
+                self.head_to_bbl_head[head] = bbl_head
         return bbls
 
     def get_instr_operands(self, head):
         """
         @head - instruction address
-        @return - the function returns list of variables which is
-        used in the instruction
+        @return - the function returns list of (text, type, value)
+        triples for operands used in the instruction
         """
+        instr_op = self._ops_cache.get(head, None)
+        if instr_op != None:
+            return instr_op
         instr_op = list()
-        for i in range(6):
-            op = idc.print_operand(head, i)
-            if op != "":
-                instr_op.append((op, idc.get_operand_type(head, i)))
+        # One decode_insn per instruction; type and value come from the
+        # op_t fields instead of one idc round-trip per operand each.
+        insn = _insn_t()
+        if _decode_insn(insn, head) > 0:
+            for i in range(6):
+                op = insn.ops[i]
+                op_type = op.type
+                if op_type == ida_ua.o_void:
+                    break
+                # interned: identical operand text recurs across the
+                # whole function, and interning lets the == and dict
+                # lookups on it hit the pointer-equality fast path
+                text = sys.intern(_print_operand(head, i))
+                if text == "":
+                    continue
+                # same per-type selection as idc.get_operand_value
+                if op_type == idc.o_reg:
+                    value = op.reg
+                elif op_type == idc.o_imm:
+                    value = op.value
+                elif op_type == idc.o_phrase:
+                    value = op.phrase
+                elif op_type == idc.o_mem or op_type == idc.o_displ or \
+                        op_type == idc.o_far or op_type == idc.o_near:
+                    value = op.addr
+                else:
+                    value = -1
+                instr_op.append((text, op_type, value))
+        self._ops_cache[head] = instr_op
         return instr_op
 
-    def is_operand_called(self, op, bbl):
-        '''
-        The function checks whether operand used for call instruction in the
-        following instructions or not.
-        @op - operand
-        @bbl - list of instructions in bbl
-        @return - True if used
-        '''
-        for instr in bbl:
-            instr_type = self.GetInstructionType(int(instr, 16))
-            if instr_type == inType.CALL or instr_type == inType.CONDITIONAL_BRANCH:
-                instr_ops = self.get_instr_operands(int(instr, 16))
-                if op in instr_ops:
-                    return True
-                #trying to replace ds: and check it again
-                op = op.replace("ds:", "")
-                comment = idc.GetDisasm(int(instr, 16))
-                if comment != None and op in comment:
-                    return True
-        return False
-
     def get_function_args_count(self, function_ea, local_vars):
         """
         The function returns count of function arguments
@@ -757,22 +978,21 @@ class Metrics_function:
         # i#9 Now, we can't identify fastcall functions.
 
         function_args_count = 0
-        args_dict = dict()
+        args_dict = defaultdict(list)
         for local_var in local_vars:
             usage_list = local_vars.get(local_var, None)
             if usage_list == None:
                 print("WARNING: empty usage list for ", local_var)
                 continue
             for head in usage_list:
-                ops = self.get_instr_operands(int(head, 16))
-                for idx, (op, type) in enumerate(ops):
+                ops = self.get_instr_operands(head)
+                for op, type, value in ops:
                     if op.count("+") == 1:
-                        value = idc.get_operand_value(int(head, 16), idx)
                         if value < (15 * ARGUMENT_SIZE) and "ebp" in op:
-                            args_dict.setdefault(local_var, []).append(head)
+                            args_dict[local_var].append(head)
                     elif op.count("+") == 2:
                         if "arg" in local_var:
-                            args_dict.setdefault(local_var, []).append(head)
+                            args_dict[local_var].append(head)
                     else:
                         continue
 
@@ -781,30 +1001,31 @@ class Metrics_function:
             return function_args_count, args_dict
 
         #TODO Check previous algorithm here
-        f_end = idc.find_func_end(function_ea)
-        f_end = idc.prev_head(f_end, 0)
-        instr_mnem = idc.print_insn_mnem(f_end)
+        f_end = idc.prev_head(self.function_end, 0)
+        instr_mnem = self.get_instr_mnem(f_end)
         #stdcall ?
         if "ret" in instr_mnem:
             ops = self.get_instr_operands(f_end)
             if len(ops) == 1:
-                for op, type in ops:
-                    op = op.replace("h", "")
-                    function_args_count = int(op, 16) / ARGUMENT_SIZE
-                    return function_args_count, args_dict
+                # the cached operand value is the immediate itself, no
+                # need to re-parse the printed hex text
+                function_args_count = ops[0][2] / ARGUMENT_SIZE
+                return function_args_count, args_dict
         #cdecl ?
-        refs = idautils.CodeRefsTo(function_ea, 0)
+        if self.callers_of != None:
+            refs = self.callers_of.get(function_ea, ())
+        else:
+            refs = idautils.CodeRefsTo(function_ea, 0)
         for ref in refs:
-            #trying to find add esp,x signature after call
-            head = idc.next_head(ref, idaapi.BADADDR)
-            if head:
-                disasm = idc.GetDisasm(head)
+            #trying to find add esp,x signature after call; the first
+            #matching call site settles the convention
+            head = _next_head(ref, _BADADDR)
+            if head != _BADADDR:
+                disasm = self.get_disasm(head)
                 if "add" in disasm and "esp," in disasm:
                     ops = self.get_instr_operands(head)
-                    op, type = ops[1]
-                    if op:
-                        op = op.replace("h", "")
-                        function_args_count = int(op, 16) / ARGUMENT_SIZE
+                    if len(ops) > 1:
+                        function_args_count = ops[1][2] / ARGUMENT_SIZE
                         return function_args_count, args_dict
         return function_args_count, args_dict
 
@@ -815,16 +1036,34 @@ class Metrics_function:
         @return - span metric
         """
         span_metric = 0
+        get_type = self.GetInstructionType
+        get_ops = self.get_instr_operands
+        call_type = inType.CALL
+        branch_type = inType.CONDITIONAL_BRANCH
+        o_mem = idc.o_mem
+        o_displ = idc.o_displ
         for bbl_key, bbl in bbls_dict.items():
+            # Collect the operands and disassembly text of the bbl's
+            # call/branch instructions once, so the per-operand check
+            # below is a set lookup instead of a rescan of the bbl.
+            call_ops = set()
+            call_disasm = []
+            for head in bbl:
+                instr_type = get_type(head)
+                if instr_type == call_type or instr_type == branch_type:
+                    for op, type, value in get_ops(head):
+                        call_ops.add(op)
+                    call_disasm.append(self.get_disasm(head))
+            call_disasm = "\n".join(call_disasm)
             for head in bbl:
-                instr_op = self.get_instr_operands(int(head, 16))
-                instr_type = self.GetInstructionType(int(head, 16))
-                if instr_type == inType.CALL or instr_type == inType.CONDITIONAL_BRANCH:
+                instr_type = get_type(head)
+                if instr_type == call_type or instr_type == branch_type:
                     continue
-                for op, type in instr_op:
-                    if self.is_operand_called(op, bbl):
+                for op, type, value in get_ops(head):
+                    if op in call_ops or op.replace("ds:",
+                                                    "") in call_disasm:
                         continue
-                    if type >= idc.o_mem and type <= idc.o_displ:
+                    if o_mem <= type <= o_displ:
                         span_metric += 1
         return span_metric
 
@@ -835,10 +1074,19 @@ class Metrics_function:
         '''
         if operand == -1:
             return False
+        cached = self._global_cache.get(operand, None)
+        if cached != None:
+            return cached
+        # Only "more than one data xref" matters, so stop as soon as a
+        # second reference shows up instead of materializing them all.
         refs = idautils.DataRefsTo(operand)
-        if len(list(refs)) > 1:
-            return True
-        return False
+        first = next(refs, None)
+        if first == None:
+            is_global = False
+        else:
+            is_global = next(refs, None) != None
+        self._global_cache[operand] = is_global
+        return is_global
 
     def get_local_var_name(self, operand, head):
         '''
@@ -849,31 +1097,23 @@ class Metrics_function:
         '''
         # i#8 Now we can't identify variables which is handled by registers.
         # We can only identify stack local variables.
-        operand = operand.replace(" ", "")
+        operand = operand.translate(_no_space)
         name = ""
 
-        if operand.count("+") == 1:
+        plus_count = operand.count("+")
+        if plus_count == 1:
             # [base reg+name]
-            name = operand[operand.find("+") + 1:operand.find("]")]
-        elif operand.count("+") == 2:
+            tail = operand.partition("+")[2]
+            name = sys.intern(tail[:tail.find("]")])
+        elif plus_count == 2:
             # [base reg + reg + name]
-            name = operand[operand.rfind("+") + 1:operand.find("]")]
-        elif operand.count("+") > 2:
-            #try to find var_XX mask
-            if "var_" in operand:
-                # [reg1+x*reg2+arg_XX+value] or [reg1+x*reg2+value+arg_XX]
-                if operand.find("var_") > operand.rfind("+"):
-                    operand = operand[operand.find("var_"):operand.find("]")]
-                else:
-                    operand = operand[operand.find("var_"):operand.rfind("+")]
-            #try to find arg_XX mask
-            elif "arg_" in operand:
-                # [reg1+x*reg2+arg_XX+value] or [reg1+x*reg2+value+arg_XX]
-                if operand.find("var_") > operand.rfind("+"):
-                    operand = operand[operand.find("arg_"):operand.find("]")]
-                else:
-                    operand = operand[operand.find("arg_"):operand.rfind("+")]
-            else:
+            tail = operand.rpartition("+")[2]
+            name = sys.intern(tail[:tail.find("]")])
+        elif plus_count > 2:
+            # [reg1+x*reg2+var_XX+value] or [reg1+x*reg2+value+arg_XX];
+            # these masks are recognized but, as before, no name is
+            # extracted for them.
+            if "var_" not in operand and "arg_" not in operand:
                 print("WARNING: unknown operand mask ", operand, hex(head))
                 name = None
         else:
@@ -887,6 +1127,8 @@ class Metrics_function:
         @return - Oviedo's DF value
         '''
         oviedo_df = 0
+        get_mnem = self.get_instr_mnem
+        get_ops = self.get_instr_operands
         # get local variables usage count, except initialization, such as:
         # mov [ebp+var_0], some_value
         for local_var in local_vars:
@@ -895,14 +1137,11 @@ class Metrics_function:
                 print("WARNING: empty usage list for ", local_var)
                 continue
             for instr_addr in usage_list:
-                instr_mnem = idc.print_insn_mnem(int(instr_addr, 16))
-                if instr_mnem.startswith('mov'):
-                    # get local var position
-                    operands = self.get_instr_operands(int(instr_addr, 16))
-                    for idx, (operand, type) in enumerate(operands):
-                        if local_var in operand and idx == 0:
-                            oviedo_df -= 1
-                            break
+                if get_mnem(instr_addr).startswith('mov'):
+                    # only the destination operand marks an initialization
+                    operands = get_ops(instr_addr)
+                    if operands and local_var in operands[0][0]:
+                        oviedo_df -= 1
             oviedo_df += len(usage_list)
         return oviedo_df
 
@@ -915,55 +1154,92 @@ class Metrics_function:
         '''
         tmp_dict_read = dict()
         tmp_dict_write = dict()
+        get_type = self.GetInstructionType
+        get_ops = self.get_instr_operands
+        assignment_type = inType.ASSIGNMENT
+        compare_type = inType.COMPARE
         for arg_var in vars_dict:
             usage_list = vars_dict.get(arg_var, None)
             if usage_list == None:
                 print("WARNING: empty usage list for ", arg_var)
                 continue
             for instr_addr in usage_list:
-                instr_type = self.GetInstructionType(int(instr_addr, 16))
-                if instr_type == inType.ASSIGNMENT:
-                    #detect operand position
-                    ops = self.get_instr_operands(int(instr_addr, 16))
-                    for idx, (op, type) in enumerate(ops):
-                        if arg_var in op and idx == 0:
+                instr_type = get_type(instr_addr)
+                if instr_type == assignment_type:
+                    #detect operand position: destination means a write,
+                    #any source operand means a read
+                    ops = get_ops(instr_addr)
+                    if ops:
+                        if arg_var in ops[0][0]:
                             tmp_dict_write[arg_var] = tmp_dict_write.get(
                                 arg_var, 0) + 1
-                            break
-                        else:
+                        elif any(arg_var in op for op, type, value in ops[1:]):
                             tmp_dict_read[arg_var] = tmp_dict_read.get(
                                 arg_var, 0) + 1
-                elif instr_type == inType.COMPARE:
+                elif instr_type == compare_type:
                     tmp_dict_read[arg_var] = tmp_dict_read.get(arg_var, 0) + 1
                 else:
                     continue
         return len(tmp_dict_read), len(tmp_dict_write)
 
     def GetInstructionType(self, instr_addr):
-        insn = ida_ua.insn_t()
-        inslen = ida_ua.decode_insn(insn, instr_addr)
+        instr_type = self._itype_cache.get(instr_addr, None)
+        if instr_type != None:
+            return instr_type
+        insn = _insn_t()
+        inslen = _decode_insn(insn, instr_addr)
 
         # TODO: something like `call $+5` should be exclusive
-        if ida_idp.is_call_insn(insn):
-            return inType.CALL
-        # if the coderefs target is local and next instruction is_flow, then it's condition jump (not always true)
-        # something like `jmp eax` is not available for conditional jump in x86 and x86/64
-        refs = idautils.CodeRefsFrom(instr_addr, 0)
-        refs = set(
-            filter(
-                lambda addr: addr >= self.function_start and addr <= self.
-                function_end, refs))
-        if refs:
-            n_head = idc.next_head(instr_addr, self.function_end)
-            if is_flow(ida_bytes.get_full_flags(n_head)):
-                return inType.CONDITIONAL_BRANCH
+        if _is_call_insn(insn):
+            instr_type = inType.CALL
+        else:
+            # if the coderefs target is local and next instruction is_flow, then it's condition jump (not always true)
+            # something like `jmp eax` is not available for conditional jump in x86 and x86/64
+            has_local_ref = False
+            for addr in idautils.CodeRefsFrom(instr_addr, 0):
+                if self.function_start <= addr <= self.function_end:
+                    has_local_ref = True
+                    break
+            if has_local_ref:
+                n_head = _next_head(instr_addr, self.function_end)
+                if is_flow(_get_full_flags(n_head)):
+                    instr_type = inType.CONDITIONAL_BRANCH
+                else:
+                    instr_type = inType.UNCONDITIONAL_BRACH
+            elif _has_insn_feature(insn.itype, CF_CHG):
+                instr_type = inType.ASSIGNMENT
+            elif _has_insn_feature(insn.itype, CF_USE):
+                instr_type = inType.COMPARE
             else:
-                return inType.UNCONDITIONAL_BRACH
-        if ida_idp.has_insn_feature(insn.itype, CF_CHG):
-            return inType.ASSIGNMENT
-        if ida_idp.has_insn_feature(insn.itype, CF_USE):
-            return inType.COMPARE
-        return inType.OTHERS
+                instr_type = inType.OTHERS
+        self._itype_cache[instr_addr] = instr_type
+        return instr_type
+
+    def get_disasm(self, head):
+        """
+        @head - instruction address
+        @return - disassembly text without color tags or comments,
+        cached per address
+        """
+        line = self._disasm_cache.get(head, None)
+        if line == None:
+            line = ida_lines.generate_disasm_line(
+                head, ida_lines.GENDSM_REMOVE_TAGS)
+            if line == None:
+                line = ""
+            self._disasm_cache[head] = line
+        return line
+
+    def get_instr_mnem(self, head):
+        """
+        @head - instruction address
+        @return - instruction mnemonic, cached per address
+        """
+        mnem = self._mnem_cache.get(head, None)
+        if mnem == None:
+            mnem = _print_insn_mnem(head)
+            self._mnem_cache[head] = mnem
+        return mnem
 
 
 class Metrics:
@@ -992,6 +1268,8 @@ class Metrics:
         self.HenrynCafura_total = 0.0
         self.CardnGlass_total = 0.0
         self.functions = dict()
+        self.analyzed_functions = list()
+        self._analyzed_eas = set()
 
     def start_analysis(self, metrics_used):
         """
@@ -1001,33 +1279,113 @@ class Metrics:
         @return - None
         """
         self.metrics_mask = metrics_used
-        # For each of the segments
+        # The results depend only on the analyzed file and the metrics
+        # mask, so an unchanged binary can be served from disk.
+        if self._load_cached_results():
+            print("Metrics loaded from cache")
+            return
+        # Build the callers map in one pass up front so per-function
+        # fan-in and calling-convention checks don't re-query xrefs.
+        self.callers_of = dict()
+        for func_ea in idautils.Functions():
+            self.callers_of[func_ea] = list(idautils.CodeRefsTo(func_ea, 0))
+        # Collect the work list first: for each of the segments, each of
+        # the functions, deduplicated by address so overlapping segment
+        # walks are skipped without a name lookup
+        function_eas = list()
         for seg_ea in idautils.Segments():
-            # For each of the functions
             function_ea = seg_ea
             while function_ea != idaapi.BADADDR:
-                function_name = idc.get_func_name(function_ea)
-                # if already analyzed
-                if self.functions.get(function_name, None) != None:
-                    function_ea = idc.get_next_func(function_ea)
-                    continue
-                print(f"Analysing {function_name}@{hex(function_ea)}")
-                try:
-                    self.functions[function_name] = Metrics_function(
-                        function_ea, self.metrics_mask)
-                    self.functions[function_name].start_analysis()
-
-                except Exception as e:
-                    print(
-                        f"Can't collect metric for function {function_name}@{hex(function_ea)}"
-                    )
-                    print(f"{e}")
-                    print('Skip')
-                    function_ea = idc.get_next_func(function_ea)
-                    continue
-                self.collect_total_metrics(function_name)
+                if function_ea not in self._analyzed_eas:
+                    self._analyzed_eas.add(function_ea)
+                    function_eas.append(function_ea)
                 function_ea = idc.get_next_func(function_ea)
+        # The analyses are independent of each other, but the IDAPython
+        # API is only safe to use from IDA's main thread, so the batch
+        # runs sequentially.
+        for function_ea in function_eas:
+            self._analyze_one(function_ea)
+        # One collection at the aggregation boundary instead of one per
+        # analyzed function.
+        gc.collect()
+        self.collect_total_metrics()
         self.collect_final_metrics()
+        self._save_cached_results()
+
+    def _analyze_one(self, function_ea):
+        '''
+        The function analyzes a single function and records the result.
+        @function_ea - function entry point
+        '''
+        function_name = idc.get_func_name(function_ea)
+        print(f"Analysing {function_name}@{hex(function_ea)}")
+        try:
+            self.functions[function_name] = Metrics_function(
+                function_ea, self.metrics_mask, function_name,
+                self.callers_of)
+            self.functions[function_name].start_analysis()
+        except Exception as e:
+            print(
+                f"Can't collect metric for function {function_name}@{hex(function_ea)}"
+            )
+            print(f"{e}")
+            print('Skip')
+            return
+        self.analyzed_functions.append(function_name)
+
+    def _get_cache_path(self):
+        '''
+        The function builds the on-disk cache file name for the analyzed
+        binary, keyed by its contents hash, mtime and the metrics mask.
+        @return - cache file path or None if the input file is not
+        reachable
+        '''
+        try:
+            input_path = ida_nalt.get_input_file_path()
+            with open(input_path, 'rb') as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+            mtime = int(os.path.getmtime(input_path))
+        except (OSError, TypeError):
+            return None
+        mask = ''.join(
+            str(self.metrics_mask.get(metric, 0)) for metric in metrics_list)
+        cache_dir = os.path.join(os.path.expanduser("~"), ".cache",
+                                 "idametrics")
+        return os.path.join(cache_dir, f"{digest}_{mtime}_{mask}.pickle")
+
+    def _load_cached_results(self):
+        '''
+        The function restores a previously saved analysis of the same
+        binary, if any.
+        @return - True on a cache hit
+        '''
+        cache_path = self._get_cache_path()
+        if cache_path == None or not os.path.isfile(cache_path):
+            return False
+        try:
+            with open(cache_path, 'rb') as f:
+                state = pickle.load(f)
+        except Exception as e:
+            print("WARNING: can't load the metrics cache: ", e)
+            return False
+        self.__dict__.update(state)
+        return True
+
+    def _save_cached_results(self):
+        '''
+        The function saves the finished analysis for reuse by later runs
+        on the same binary. Failures only cost the cache, so they are
+        reported and ignored.
+        '''
+        cache_path = self._get_cache_path()
+        if cache_path == None:
+            return
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            with open(cache_path, 'wb') as f:
+                pickle.dump(self.__dict__, f, pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            print("WARNING: can't save the metrics cache: ", e)
 
     def collect_final_metrics(self):
         ''' The routine collect some metrics that should be calculated after analysis
@@ -1041,47 +1399,45 @@ class Metrics:
         if self.metrics_mask["cocol"] == 1:
             self.Cocol_total += self.Halstead_total.B + self.CC_total + self.total_loc_count
 
-    def collect_total_metrics(self, function_name):
-        ''' The routine is used to add function measures to total metrics evaluation
-        @function_name - name of function
+    def collect_total_metrics(self):
+        ''' The routine sums function measures into the total metrics
+        evaluation. Aggregation happens in single passes over the list
+        of successfully analyzed functions instead of attribute-by-
+        attribute updates per function.
         '''
-        self.total_loc_count += self.functions[function_name].loc_count
-        self.total_bbl_count += self.functions[function_name].bbl_count
-        self.total_func_count += 1
-        self.total_condition_count += self.functions[
-            function_name].condition_count
-        self.total_assign_count += self.functions[function_name].assign_count
-        self.R_total += self.functions[function_name].R
-
-        self.CC_modified_total += self.functions[function_name].CC_modified
-        self.Pivovarsky_total += self.functions[function_name].Pivovarsky
-        self.Harrison_total += self.functions[function_name].Harrison
-        self.boundary_values_total += self.functions[
-            function_name].boundary_values
-
-        self.Halstead_total.n1 += self.functions[
-            function_name].Halstead_basic.n1
-        self.Halstead_total.n2 += self.functions[
-            function_name].Halstead_basic.n2
-        self.Halstead_total.N1 += self.functions[
-            function_name].Halstead_basic.N1
-        self.Halstead_total.N2 += self.functions[
-            function_name].Halstead_basic.N2
-
-        self.CC_total += self.functions[function_name].CC
-        self.CL_total += self.functions[function_name].CL
-        self.ABC_total += self.functions[function_name].ABC
-
-        self.span_metric_total += self.functions[function_name].span_metric
-        self.Oviedo_total += self.functions[function_name].Oviedo
-        self.Chepin_total += self.functions[function_name].Chepin
-        self.HenrynCafura_total += self.functions[function_name].HenrynCafura
-        self.CardnGlass_total += self.functions[function_name].CardnGlass
+        analyzed = [self.functions[name] for name in self.analyzed_functions]
+        self.total_func_count = len(analyzed)
+        self.total_loc_count = sum(fn.loc_count for fn in analyzed)
+        self.total_bbl_count = sum(fn.bbl_count for fn in analyzed)
+        self.total_condition_count = sum(fn.condition_count
+                                         for fn in analyzed)
+        self.total_assign_count = sum(fn.assign_count for fn in analyzed)
+        self.R_total = sum(fn.R for fn in analyzed)
+
+        self.CC_modified_total = sum(fn.CC_modified for fn in analyzed)
+        self.Pivovarsky_total = sum(fn.Pivovarsky for fn in analyzed)
+        self.Harrison_total = sum(fn.Harrison for fn in analyzed)
+        self.boundary_values_total = sum(fn.boundary_values
+                                         for fn in analyzed)
+
+        self.Halstead_total.n1 = sum(fn.Halstead_basic.n1 for fn in analyzed)
+        self.Halstead_total.n2 = sum(fn.Halstead_basic.n2 for fn in analyzed)
+        self.Halstead_total.N1 = sum(fn.Halstead_basic.N1 for fn in analyzed)
+        self.Halstead_total.N2 = sum(fn.Halstead_basic.N2 for fn in analyzed)
+
+        self.CC_total = sum(fn.CC for fn in analyzed)
+        self.CL_total = sum(fn.CL for fn in analyzed)
+        self.ABC_total = sum(fn.ABC for fn in analyzed)
+
+        self.span_metric_total = sum(fn.span_metric for fn in analyzed)
+        self.Oviedo_total = sum(fn.Oviedo for fn in analyzed)
+        self.Chepin_total = sum(fn.Chepin for fn in analyzed)
+        self.HenrynCafura_total = sum(fn.HenrynCafura for fn in analyzed)
+        self.CardnGlass_total = sum(fn.CardnGlass for fn in analyzed)
 
         if self.metrics_mask["cocol"] == 1:
-            self.functions[function_name].Cocol = self.functions[
-                function_name].Halstead_basic.B + self.functions[
-                    function_name].CC + self.functions[function_name].loc_count
+            for fn in analyzed:
+                fn.Cocol = fn.Halstead_basic.B + fn.CC + fn.loc_count
 
     def add_global_vars_metric(self):
         '''
@@ -1089,12 +1445,15 @@ class Metrics:
         @return - total access count
         '''
 
-        total_metric_count = 0
-        for function in self.functions:
-            if len(global_vars_dict) > 0:
-                self.functions[function].global_vars_metric = self.functions[
-                    function].global_vars_access / len(global_vars_dict)
-            total_metric_count += self.functions[function].global_vars_metric
+        global_vars_count = len(global_vars_dict)
+        if global_vars_count == 0:
+            return 0.0
+        total_metric_count = 0.0
+        for function_metrics in self.functions.values():
+            if function_metrics.global_vars_access:
+                function_metrics.global_vars_metric = \
+                    function_metrics.global_vars_access / global_vars_count
+                total_metric_count += function_metrics.global_vars_metric
         return total_metric_count
 
 
@@ -1135,42 +1494,44 @@ class Metrics:
             'cardnglass metric',
             'henryncafura metric'
         ]
-        # saving header
-        f.write(','.join(header_functions))
-        f.write('\n')
-        # saving functions data
+        # saving header and functions data, one writerow per line
+        # instead of one write call per cell
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(header_functions)
         for function in self.functions:
             cf = self.functions[function]
-            f.write(str(function) + ",")
-            f.write(("%.2f" % cf.loc_count) + ",")
-            f.write(("%.2f" % cf.bbl_count) + ",")
-            f.write(("%.2f" % cf.condition_count) + ",")
-            f.write(("%.2f" % cf.calls_count) + ",")
-            f.write(("%.2f" % cf.assign_count) + ",")
-            f.write(("%.2f" % cf.CC) + ",")
-            f.write(("%.2f" % cf.CC_modified) + ",")
-            f.write(("%.2f" % cf.CL) + ",")
-            f.write(("%.2f" % cf.ABC) + ",")
-            f.write(("%.2f" % cf.R) + ",")
-            f.write(("%.2f" % cf.Halstead_basic.B) + ",")
-            f.write(("%.2f" % cf.Halstead_basic.E) + ",")
-            f.write(("%.2f" % cf.Halstead_basic.D) + ",")
-            f.write(("%.2f" % cf.Halstead_basic.Ni) + ",")
-            f.write(("%.2f" % cf.Halstead_basic.V) + ",")
-            f.write(("%.2f" % cf.Halstead_basic.N1) + ",")
-            f.write(("%.2f" % cf.Halstead_basic.N2) + ",")
-            f.write(("%.2f" % cf.Halstead_basic.n1) + ",")
-            f.write(("%.2f" % cf.Halstead_basic.n2) + ",")
-            f.write(("%.2f" % cf.Pivovarsky) + ",")
-            f.write(("%.2f" % cf.Harrison) + ",")
-            f.write(("%.2f" % cf.Cocol) + ",")
-            f.write(("%.2f" % cf.boundary_values) + ",")
-            f.write(("%.2f" % cf.span_metric) + ",")
-            f.write(("%.2f" % cf.global_vars_metric) + ",")
-            f.write(("%.2f" % cf.Oviedo) + ",")
-            f.write(("%.2f" % cf.Chepin) + ",")
-            f.write(("%.2f" % cf.CardnGlass) + ",")
-            f.write(("%.2f" % cf.HenrynCafura) + "\n")
+            writer.writerow((
+                str(function),
+                "%.2f" % cf.loc_count,
+                "%.2f" % cf.bbl_count,
+                "%.2f" % cf.condition_count,
+                "%.2f" % cf.calls_count,
+                "%.2f" % cf.assign_count,
+                "%.2f" % cf.CC,
+                "%.2f" % cf.CC_modified,
+                "%.2f" % cf.CL,
+                "%.2f" % cf.ABC,
+                "%.2f" % cf.R,
+                "%.2f" % cf.Halstead_basic.B,
+                "%.2f" % cf.Halstead_basic.E,
+                "%.2f" % cf.Halstead_basic.D,
+                "%.2f" % cf.Halstead_basic.Ni,
+                "%.2f" % cf.Halstead_basic.V,
+                "%.2f" % cf.Halstead_basic.N1,
+                "%.2f" % cf.Halstead_basic.N2,
+                "%.2f" % cf.Halstead_basic.n1,
+                "%.2f" % cf.Halstead_basic.n2,
+                "%.2f" % cf.Pivovarsky,
+                "%.2f" % cf.Harrison,
+                "%.2f" % cf.Cocol,
+                "%.2f" % cf.boundary_values,
+                "%.2f" % cf.span_metric,
+                "%.2f" % cf.global_vars_metric,
+                "%.2f" % cf.Oviedo,
+                "%.2f" % cf.Chepin,
+                "%.2f" % cf.CardnGlass,
+                "%.2f" % cf.HenrynCafura,
+            ))
         f.close()
 
     def save_results(self, name):
@@ -1199,90 +1560,61 @@ class Metrics:
         if name == None:
             return 0
         f = open(name, 'w')
-        f.write('Average lines of code in a function: ' +
-                str(self.average_loc_count) + "\n")
-        f.write('Total number of functions: ' + str(self.total_func_count) +
-                "\n")
-        f.write('Total lines of code: ' + str(self.total_loc_count) + "\n")
-        f.write('Total bbl count: ' + str(self.total_bbl_count) + "\n")
-        f.write('Total assignments count: ' + str(self.total_assign_count) +
-                "\n")
-        f.write('Total R count: ' + str(self.R_total) + "\n")
-        f.write('Total Cyclomatic complexity: ' + str(self.CC_total) + "\n")
-        f.write('Total Jilb\'s metric: ' + str(self.CL_total) + "\n")
-        f.write('Total ABC: ' + str(self.ABC_total) + "\n")
-        f.write('Total Halstead:' + str(self.Halstead_total.B) + "\n")
-        f.write('Total Pivovarsky: ' + str(self.Pivovarsky_total) + "\n")
-        f.write('Total Harrison: ' + str(self.Harrison_total) + "\n")
-        f.write('Total Boundary value: ' + str(self.boundary_values_total) +
-                "\n")
-        f.write('Total Span metric: ' + str(self.span_metric_total) + "\n")
-        f.write('Total Oviedo metric: ' + str(self.Oviedo_total) + "\n")
-        f.write('Total Chepin metric: ' + str(self.Chepin_total) + "\n")
-        f.write('Henry&Cafura metric: ' + str(self.HenrynCafura_total) + "\n")
-        f.write('Cocol metric: ' + str(self.Cocol_total) + "\n")
-        f.write('CardnGlass metric: ' + str(self.CardnGlass_total) + "\n")
+        chunks = [
+            f"Average lines of code in a function: {self.average_loc_count}\n"
+            f"Total number of functions: {self.total_func_count}\n"
+            f"Total lines of code: {self.total_loc_count}\n"
+            f"Total bbl count: {self.total_bbl_count}\n"
+            f"Total assignments count: {self.total_assign_count}\n"
+            f"Total R count: {self.R_total}\n"
+            f"Total Cyclomatic complexity: {self.CC_total}\n"
+            f"Total Jilb's metric: {self.CL_total}\n"
+            f"Total ABC: {self.ABC_total}\n"
+            f"Total Halstead:{self.Halstead_total.B}\n"
+            f"Total Pivovarsky: {self.Pivovarsky_total}\n"
+            f"Total Harrison: {self.Harrison_total}\n"
+            f"Total Boundary value: {self.boundary_values_total}\n"
+            f"Total Span metric: {self.span_metric_total}\n"
+            f"Total Oviedo metric: {self.Oviedo_total}\n"
+            f"Total Chepin metric: {self.Chepin_total}\n"
+            f"Henry&Cafura metric: {self.HenrynCafura_total}\n"
+            f"Cocol metric: {self.Cocol_total}\n"
+            f"CardnGlass metric: {self.CardnGlass_total}\n"
+        ]
         for function in self.functions:
-            f.write(str(function) + "\n")
-            f.write('  Lines of code in the function: ' +
-                    str(self.functions[function].loc_count) + "\n")
-            f.write('  Bbls count: ' +
-                    str(self.functions[function].bbl_count) + "\n")
-            f.write('  Condition count: ' +
-                    str(self.functions[function].condition_count) + "\n")
-            f.write('  Calls count: ' +
-                    str(self.functions[function].calls_count) + "\n")
-            f.write('  Assignments count: ' +
-                    str(self.functions[function].assign_count) + "\n")
-            f.write('  Cyclomatic complexity: ' +
-                    str(self.functions[function].CC) + "\n")
-            f.write('  Cyclomatic complexity modified: ' +
-                    str(self.functions[function].CC_modified) + "\n")
-            f.write('  Jilb\'s metric: ' + str(self.functions[function].CL) +
-                    "\n")
-            f.write('  ABC: ' + str(self.functions[function].ABC) + "\n")
-            f.write('  R count: ' + str(self.functions[function].R) + "\n")
-
-            f.write('    Halstead.B: ' +
-                    str(self.functions[function].Halstead_basic.B) + "\n")
-            f.write('    Halstead.E: ' +
-                    str(self.functions[function].Halstead_basic.E) + "\n")
-            f.write('    Halstead.D: ' +
-                    str(self.functions[function].Halstead_basic.D) + "\n")
-            f.write('    Halstead.N*: ' +
-                    str(self.functions[function].Halstead_basic.Ni) + "\n")
-            f.write('    Halstead.V: ' +
-                    str(self.functions[function].Halstead_basic.V) + "\n")
-            f.write('    Halstead.N1: ' +
-                    str(self.functions[function].Halstead_basic.N1) + "\n")
-            f.write('    Halstead.N2: ' +
-                    str(self.functions[function].Halstead_basic.N2) + "\n")
-            f.write('    Halstead.n1: ' +
-                    str(self.functions[function].Halstead_basic.n1) + "\n")
-            f.write('    Halstead.n2: ' +
-                    str(self.functions[function].Halstead_basic.n2) + "\n")
-
-            f.write('  Pivovarsky: ' +
-                    str(self.functions[function].Pivovarsky) + "\n")
-            f.write('  Harrison: ' + str(self.functions[function].Harrison) +
-                    "\n")
-            f.write('  Cocol metric' + str(self.functions[function].Cocol) +
-                    "\n")
-
-            f.write('  Boundary value: ' +
-                    str(self.functions[function].boundary_values) + "\n")
-            f.write('  Span metric: ' +
-                    str(self.functions[function].span_metric) + "\n")
-            f.write('  Global vars metric:' +
-                    str(self.functions[function].global_vars_metric) + "\n")
-            f.write('  Oviedo metric: ' +
-                    str(self.functions[function].Oviedo) + "\n")
-            f.write('  Chepin metric: ' +
-                    str(self.functions[function].Chepin) + "\n")
-            f.write('  CardnGlass metric: ' +
-                    str(self.functions[function].CardnGlass) + "\n")
-            f.write('  Henry&Cafura metric: ' +
-                    str(self.functions[function].HenrynCafura) + "\n")
+            cf = self.functions[function]
+            chunks.append(
+                _FUNC_TMPL.format(name=function,
+                                  loc_count=cf.loc_count,
+                                  bbl_count=cf.bbl_count,
+                                  condition_count=cf.condition_count,
+                                  calls_count=cf.calls_count,
+                                  assign_count=cf.assign_count,
+                                  CC=cf.CC,
+                                  CC_modified=cf.CC_modified,
+                                  CL=cf.CL,
+                                  ABC=cf.ABC,
+                                  R=cf.R,
+                                  halstead_B=cf.Halstead_basic.B,
+                                  halstead_E=cf.Halstead_basic.E,
+                                  halstead_D=cf.Halstead_basic.D,
+                                  halstead_Ni=cf.Halstead_basic.Ni,
+                                  halstead_V=cf.Halstead_basic.V,
+                                  halstead_N1=cf.Halstead_basic.N1,
+                                  halstead_N2=cf.Halstead_basic.N2,
+                                  halstead_n1=cf.Halstead_basic.n1,
+                                  halstead_n2=cf.Halstead_basic.n2,
+                                  Pivovarsky=cf.Pivovarsky,
+                                  Harrison=cf.Harrison,
+                                  Cocol=cf.Cocol,
+                                  boundary_values=cf.boundary_values,
+                                  span_metric=cf.span_metric,
+                                  global_vars_metric=cf.global_vars_metric,
+                                  Oviedo=cf.Oviedo,
+                                  Chepin=cf.Chepin,
+                                  CardnGlass=cf.CardnGlass,
+                                  HenrynCafura=cf.HenrynCafura))
+        f.write(''.join(chunks))
         f.close()
 
 
@@ -1314,16 +1646,17 @@ class UI:
         self.chks = []
         self.callback = callback
         groupbox = QGroupBox('metrics')
-        groupbox.setLayout(QHBoxLayout())
+        # a single grid pass; unlike the old five-per-column layout it
+        # doesn't drop trailing metrics when the count isn't a multiple
+        # of five
+        grid = QGridLayout()
+        for i, name in enumerate(metrics_names):
+            chk = QCheckBox(name)
+            self.chks.append(chk)
+            chk.setChecked(True)
+            grid.addWidget(chk, i % 5, i // 5)
+        groupbox.setLayout(grid)
         self.panel.layout().addWidget(groupbox)
-        for col in range(len(metrics_list) // 5):
-            col_layout = QVBoxLayout()
-            for i in range(5):
-                chk = QCheckBox(metrics_names[col * 5 + i])
-                self.chks.append(chk)
-                chk.setChecked(True)
-                col_layout.addWidget(chk)
-            groupbox.layout().addLayout(col_layout)
         button = QPushButton('Confirm')
         button.clicked.connect(self.GetUserChoice)
         self.panel.layout().addWidget(button)
@@ -1360,7 +1693,7 @@ class debug:
 if __name__ == "__main__":
     ida_auto.auto_wait()  #wait while ida finish analysis
     if not idaapi.cvar.batch:
-        from PyQt5.QtWidgets import QWidget, QGroupBox, QDialog, QVBoxLayout, QHBoxLayout, QCheckBox, QLabel, QPushButton
+        from PyQt5.QtWidgets import QWidget, QGroupBox, QDialog, QVBoxLayout, QHBoxLayout, QGridLayout, QCheckBox, QLabel, QPushButton
         from PyQt5.QtWidgets import QMainWindow, QFileDialog, QDialog, QLineEdit, QMessageBox, QAction, QMenu, QApplication, QLabel
         from PyQt5 import QtCore, QtGui, QtWidgets
         ui = UI(init_analysis)